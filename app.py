@@ -2,16 +2,25 @@
 
 # SPDX-License-Identifier: BlueOak-1.0.0
 
+import collections
+import concurrent.futures
 import datetime as dt
+import errno
+import hashlib
+import itertools
 import mimetypes
+import operator
 import subprocess
 import os
+import stat
 import sys
 import tempfile
+import threading
+import time
 import urllib.parse
 import mimetypes
 from http import HTTPStatus
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path, PurePosixPath
 
 import pygments
@@ -21,7 +30,7 @@ import pygments.token
 import pygments.util
 from pygments.styles.default import DefaultStyle
 import werkzeug.exceptions
-from flask import Flask, Response, abort, render_template, request, redirect, url_for, make_response
+from flask import Flask, Response, abort, g, render_template, stream_template, request, redirect, url_for, make_response
 from werkzeug.routing import PathConverter
 
 import utils
@@ -63,6 +72,9 @@ def set_server_header(resp):
 
 base_path = Path(os.environ['DIRSERVER_BASE_PATH']).resolve()
 exclude_hidden = os.environ.get('DIRSERVER_EXCLUDE_HIDDEN', '1').lower() in ENABLED
+opus_cache_path = os.environ.get('DIRSERVER_OPUS_CACHE_PATH')
+if opus_cache_path is not None:
+	opus_cache_path = Path(opus_cache_path).resolve()
 
 def ensure_beneath(base_path, path):
 	try:
@@ -70,20 +82,31 @@ def ensure_beneath(base_path, path):
 	except RuntimeError:  # symlink recursion
 		abort(HTTPStatus.BAD_REQUEST)
 
-	if base_path not in resolved.parents:
+	# same as checking base_path in resolved.parents, without building a Path for every parent
+	if resolved == base_path or not str(resolved).startswith(os.path.join(base_path, '')):
 		abort(HTTPStatus.FORBIDDEN)
 
 	return resolved
 
 ensure_in_base_path = partial(ensure_beneath, base_path)
 
+# stat() errors that mean there's nothing to serve there. ELOOP is a symlink loop,
+# which resolve() no longer reports by itself as of Python 3.13.
+NOT_FOUND_ERRNOS = frozenset({errno.ENOENT, errno.ENOTDIR, errno.ELOOP})
+
 class SafePathConverter(PathConverter):
 	def to_python(self, value):
 		p = ensure_in_base_path(Path(value))
-		if not p.exists():
-			abort(HTTPStatus.NOT_FOUND)
-		if p.is_dir() and exclude_hidden and any(part.startswith('.') for part in p.parts):
+		try:
+			st = os.stat(p)
+		except OSError as exc:
+			if exc.errno in NOT_FOUND_ERRNOS:
+				abort(HTTPStatus.NOT_FOUND)
+			raise
+		if stat.S_ISDIR(st.st_mode) and exclude_hidden and utils.has_hidden_component(str(p)):
 			abort(HTTPStatus.FORBIDDEN)
+		# so that the view doesn't have to stat it again
+		g.path_stat = p, st
 		return p
 
 	def to_url(self, path):
@@ -91,56 +114,185 @@ class SafePathConverter(PathConverter):
 
 app.url_map.converters['safe_path'] = SafePathConverter
 
+def path_stat(path):
+	"""Return os.stat(path), reusing the result from routing if it was for the same path."""
+	routed = g.get('path_stat')
+	if routed is not None and routed[0] == path:
+		return routed[1]
+	return os.stat(path)
+
 OPUSENC_FLAGS = ['--padding', '0', '--bitrate', '160']
 
+# common extensions that Pygments has no lexer for, which we don't need to ask it about
+NEVER_HIGHLIGHT = frozenset('''
+	.jpg .jpeg .png .gif .webp .bmp .ico .tif .tiff
+	.mp3 .flac .ogg .opus .wav .aif .aiff .m4a .aac
+	.mp4 .m4v .mkv .webm .avi .mov
+	.zip .tar .gz .bz2 .xz .zst .7z .rar .iso .img
+	.bin .exe .dll .so .o .a .pyc .class .jar .deb .rpm
+	.pdf .epub .djvu .doc .docx .xls .xlsx .ppt .pptx .odt
+	.ttf .otf .woff .woff2 .sqlite .db
+'''.split())
+
+@lru_cache(maxsize=256)
+def has_lexer_for_mimetype(mime_type):
+	try:
+		pygments.lexers.get_lexer_for_mimetype(mime_type)
+	except pygments.util.ClassNotFound:
+		return False
+	return True
+
+@lru_cache(maxsize=1024)
+def is_highlightable(ext):
+	# many extensions share a mimetype (e.g. all the text/plain ones from utils), so cache that lookup separately
+	return has_lexer_for_mimetype(mimetypes.guess_type('x' + ext)[0])
+
 class DisplayPath:
+	__slots__ = (
+		'_path', 'is_symlink', 'is_file', 'is_dir', 'stat', 'name', '_name_lower',
+		'modified', 'size', '_natural_size', 'highlightable', 'opus_encodable',
+	)
+
 	def __init__(self, path):
-		self.path = path
-		self.is_file = path.is_file()
-		self.is_dir = is_dir = path.is_dir()
-		self.is_symlink = path.is_symlink()
-		self.dirname = path.relative_to(base_path).parent
-		self.name = path.name + ('/' if is_dir else '')
-		self.stat = stat = path.lstat()
-		self.modified = dt.datetime.fromtimestamp(stat.st_mtime)
-		self.size = stat.st_size
-		self.natural_size = utils.natural_size(stat.st_size)
+		# path is either an os.DirEntry from scandir, which caches the file type and lstat for us,
+		# or a Path (e.g. for "..")
+		self._path = os.fspath(path)
+		if isinstance(path, os.DirEntry):
+			st = path.stat(follow_symlinks=False)
+			follow = path.stat
+		else:
+			st = os.lstat(path)
+			follow = partial(os.stat, path)
+		self.stat = st
+		# one lstat gives us everything; only symlinks need a second stat to find out what they point to
+		mode = st.st_mode
+		self.is_symlink = stat.S_ISLNK(mode)
+		if self.is_symlink:
+			try:
+				mode = follow().st_mode
+			except OSError:  # broken link
+				pass
+		self.is_file = stat.S_ISREG(mode)
+		self.is_dir = stat.S_ISDIR(mode)
+		self.name = path.name + ('/' if self.is_dir else '')
+		# sort key, computed once here rather than on every sort
+		self._name_lower = self.name.lower()
+		self.modified = dt.datetime.fromtimestamp(st.st_mtime)
+		self.size = st.st_size
 		self.highlightable = False
 		self.opus_encodable = False
 		if self.is_file:
-			try:
-				pygments.lexers.get_lexer_for_mimetype(mimetypes.guess_type(path.name)[0])
-			except pygments.util.ClassNotFound:
-				pass
-			else:
-				self.highlightable = True
+			ext = os.path.splitext(path.name)[1].lower()
+			self.highlightable = ext not in NEVER_HIGHLIGHT and is_highlightable(ext)
+			# only sniff files that are named like audio, so that listing a directory doesn't open every file in it
+			self.opus_encodable = ext in utils.AUDIO_EXTENSIONS and bool(utils.path_is_opusenc_encodable(path))
+
+	@property
+	def natural_size(self):
+		# computed on first use, since the listing only shows sizes for files
+		try:
+			return self._natural_size
+		except AttributeError:
+			self._natural_size = utils.natural_size(self.size)
+			return self._natural_size
+
+	@property
+	def path(self):
+		return Path(self._path)
 
-			self.opus_encodable = bool(utils.path_is_opusenc_encodable(path))
+	@property
+	def dirname(self):
+		return self.path.relative_to(base_path).parent
 
-def dir_first(p, key): return (0 if p.is_dir else 1, key)
+sort_by_name = operator.attrgetter('_name_lower')
 
+# sorts that mix directories in with everything else
 sort_keys = {
-	'namedirfirst': lambda p: dir_first(p, p.name.lower()),
-	'name': lambda p: p.name.lower(),
-	'time': lambda p: p.modified,
-	'size': lambda p: dir_first(p, p.name.lower() if p.is_dir else p.size),
+	'name': sort_by_name,
+	'time': operator.attrgetter('modified'),
+}
+
+# sorts that list directories first, by name, followed by everything else ordered by the given key
+# (or by name, which list_dir has already done, if the key is None)
+dir_first_sort_keys = {
+	'namedirfirst': None,
+	'size': operator.attrgetter('size'),
 }
 
 class Breadcrumb:
+	__slots__ = ('link', 'text')
+
 	def __init__(self, link, text):
 		self.link = link
 		self.text = text
 
 def breadcrumbs(path):
-	p = PurePosixPath('/')
-	for i, part in enumerate(path.parts[1:]):
-		p /= part
-		yield Breadcrumb(link=str(p) + '/', text=part)
+	parts = path.parts[1:]
+	# '/', '/a/', '/a/b/', ...
+	links = itertools.accumulate(parts, lambda link, part: f'{link}{part}/', initial='/')
+	next(links)  # the root has no breadcrumb of its own
+	return [Breadcrumb(link=link, text=part) for link, part in zip(links, parts)]
+
+listing_cache_size = int(os.environ.get('DIRSERVER_LISTING_CACHE_SIZE', '256'))
+# on network filesystems, building a DisplayPath is mostly waiting on the filesystem, so it's worth doing many at once.
+# on local disks it's mostly Python code, which threads only slow down.
+listing_workers = int(os.environ.get('DIRSERVER_LISTING_WORKERS', '1'))
+listing_pool = concurrent.futures.ThreadPoolExecutor(max_workers=listing_workers) if listing_workers > 1 else None
+# some filesystems only keep mtimes to the second or coarser (FAT: two seconds), so a directory modified this recently
+# could still change without its mtime changing. listings of such directories aren't cached.
+LISTING_CACHE_MIN_AGE_NS = 3 * 10 ** 9
+# str(path) -> (directory mtime, listing)
+listing_cache = collections.OrderedDict()
+listing_cache_lock = threading.Lock()
+
+def list_dir(path):
+	"""Return (directories, everything else, number of regular files) for the entries of path,
+	with both lists as DisplayPaths sorted by name.
+	The result is reused for as long as the directory's mtime doesn't change,
+	unless the directory was modified in the last few seconds.
+	"""
+	key = str(path)
+	mtime = path_stat(path).st_mtime_ns
+	with listing_cache_lock:
+		cached = listing_cache.get(key)
+		if cached is not None and cached[0] == mtime:
+			listing_cache.move_to_end(key)
+			return cached[1]
+
+	with os.scandir(path) as entries:
+		entries = [entry for entry in entries if not (exclude_hidden and entry.name.startswith('.'))]
+	if listing_pool is not None:
+		paths = listing_pool.map(DisplayPath, entries)
+	else:
+		paths = map(DisplayPath, entries)
+
+	dirs = []
+	files = []
+	num_files = 0
+	for p in paths:
+		if p.is_dir:
+			dirs.append(p)
+		else:
+			files.append(p)
+			num_files += p.is_file
+	# sorted once here so that the default view doesn't have to sort at all
+	dirs.sort(key=sort_by_name)
+	files.sort(key=sort_by_name)
+	listing = dirs, files, num_files
+
+	if listing_cache_size > 0 and time.time_ns() - mtime >= LISTING_CACHE_MIN_AGE_NS:
+		with listing_cache_lock:
+			listing_cache[key] = mtime, listing
+			listing_cache.move_to_end(key)
+			while len(listing_cache) > listing_cache_size:
+				listing_cache.popitem(last=False)
+
+	return listing
 
 @app.route('/', defaults={'path': base_path})
 @app.route('/<safe_path:path>')
 def index_dir(path):
-	if not path.is_dir():
+	if not stat.S_ISDIR(path_stat(path).st_mode):
 		resp = make_response('')
 		internal_path = urllib.parse.urljoin('/._protected/', urllib.parse.quote(str(path.relative_to(base_path))))
 		resp.headers['X-Accel-Redirect'] = urllib.parse.urljoin('/._protected/', internal_path)
@@ -150,21 +302,22 @@ def index_dir(path):
 	elif not request.path.endswith('/'):
 		return redirect(request.path + '/')
 
-	num_files = num_dirs = 0
-	paths = []
-	for p in path.iterdir():
-		if p.name.startswith('.') and exclude_hidden:
-			continue
-		p = DisplayPath(p)
-		if p.is_dir:
-			num_dirs += 1
-		elif p.is_file:
-			num_files += 1
-		paths.append(p)
+	dirs, files, num_files = list_dir(path)
+	num_dirs = len(dirs)
 
 	sort_key = request.args.get('sort', 'namedirfirst')
 	order = request.args.get('order', 'asc')
-	paths.sort(key=sort_keys.get(sort_key, sort_keys['namedirfirst']), reverse=order == 'desc')
+	reverse = order == 'desc'
+	# the lists may be shared with the listing cache, so build new ones rather than sorting them in place
+	if sort_key in sort_keys:
+		paths = sorted(itertools.chain(dirs, files), key=sort_keys[sort_key], reverse=reverse)
+	else:
+		key = dir_first_sort_keys.get(sort_key)
+		if key is not None:
+			files = sorted(files, key=key, reverse=reverse)
+		elif reverse:
+			files = files[::-1]
+		paths = files + dirs[::-1] if reverse else dirs + files
 
 	if path != base_path:
 		# only let people go up a directory if they actually can
@@ -180,7 +333,8 @@ def index_dir(path):
 		tar_link = '/._tar/root.tar'
 		tar_opus_link = '/._tar/root.opus.tar'
 
-	return render_template(
+	# stream large listings out as they're rendered instead of building the whole page in memory first
+	return Response(utils.coalesce(stream_template(
 		'list.html',
 		path=request.path,
 		items=paths,
@@ -192,62 +346,155 @@ def index_dir(path):
 		tar_link=tar_link,
 		tar_opus_link=tar_opus_link,
 		is_root=path==base_path,
-	)
+	)))
 
 if exclude_hidden:
-	TAR_FILTER = lambda tarinfo: None if any(part.startswith('.') for part in Path(tarinfo.name).resolve().parts) else tarinfo
+	TAR_FILTER = lambda tarinfo: None if utils.has_hidden_component(tarinfo.name) else tarinfo
 else:
 	TAR_FILTER = None
 
+# file contents are copied into the archive in chunks of this size, rather than tarfile's default of 16 KiB
+TAR_COPY_BUFSIZE = 256 * 1024
+
 @app.route('/._tar/<path:dir_name>.tar', defaults={'path': base_path})
 @app.route('/<safe_path:path>/._tar/<path:dir_name>.tar')
 @app.route('/<safe_path:path>/._tar/<path:dir_name>.opus.tar')
 def tar(path, dir_name):
 	is_opus = request.path.endswith('.opus.tar')
 	def gen():
-		tar = tarfile_stream.open(mode='w|')
+		tar = tarfile_stream.open(mode='w|', copybufsize=TAR_COPY_BUFSIZE)
 		yield from tar.header()
 		if is_opus:
-			yield from opus_adder(tar, path, arcname=Path(dir_name))
+			yield from opus_adder(tar, path, arcname=dir_name)
 		else:
 			yield from tar.add(path, arcname='' if path == base_path else dir_name, filter=TAR_FILTER)
 		yield from tar.footer()
 
-	resp = Response(gen(), mimetype='application/x-tar')
+	# with large chunks, a short queue is enough to keep the client busy
+	resp = Response(utils.pump(gen(), maxsize=16), mimetype='application/x-tar')
 	resp.headers['Content-Disposition'] = utils.content_disposition('attachment', PurePosixPath(request.path).name)
+	# let the archive through to the client as it's produced
+	resp.headers['X-Accel-Buffering'] = 'no'
 	return resp
 
+# opusenc does the actual work in its own process, so threads are enough to keep every core busy
+opus_workers = os.cpu_count() or 1
+opus_pool = concurrent.futures.ThreadPoolExecutor(max_workers=opus_workers)
+# how many files an opus tarball may have encoding (or encoded but not yet sent) at once.
+# encoded files are held in memory until they're sent, so this is capped regardless of the number of cores.
+opus_lookahead = min(2 * opus_workers, 8)
+
+def encode_opus(path):
+	return subprocess.run(
+		['opusenc', *OPUSENC_FLAGS, str(path), '-'],
+		stdin=subprocess.DEVNULL,
+		stdout=subprocess.PIPE,
+		stderr=subprocess.DEVNULL,
+	).stdout
+
+def walk_files(path, arcname):
+	# DirEntries already know whether they're directories, and keep the stat for later
+	with os.scandir(path) as entries:
+		entries = sorted(entries, key=operator.attrgetter('name'))
+	for entry in entries:
+		name = os.path.join(arcname, entry.name)
+		if entry.is_dir():
+			yield from walk_files(entry.path, name)
+		else:
+			yield entry, name
+
 def opus_adder(tar, path, arcname=None):
 	if arcname is None:
 		if path.is_dir():
-			arcname = Path(path.name)
+			arcname = path.name
 		else:
-			arcname = Path(path.with_suffix('.opus').name)
+			arcname = path.with_suffix('.opus').name
 
 	if path.is_file():
 		yield from tar.add(path, filter=TAR_FILTER)
 		return
 
-	for f in sorted(path.iterdir()):
-		if f.is_dir():
-			yield from opus_adder(tar, f, arcname / f.name)
-			continue
+	# encode several files in parallel while still writing them to the archive in traversal order.
+	# each entry is either (arcname, path to add as is, None) or (TarInfo, None, encoder future).
+	pending = collections.deque()
+	encoding = 0
+
+	def add_next():
+		nonlocal encoding
+		name, src, job = pending.popleft()
+		if job is None:
+			yield from tar.add(src, name, filter=TAR_FILTER)
+			return
 
-		if not utils.path_is_opusenc_encodable(f):
-			yield from tar.add(f, arcname / f.name, filter=TAR_FILTER)
-			continue
+		encoding -= 1
+		yield from tar.addbytes(name, job.result())
 
-		with tempfile.NamedTemporaryFile() as tmp:
-			tmp = tmp.name
-			proc = subprocess.Popen(
-				['opusenc', *OPUSENC_FLAGS, str(f), tmp],
+	try:
+		for entry, name in walk_files(path, arcname):
+			if not utils.path_is_opusenc_encodable(entry.path):
+				pending.append((name, entry.path, None))
+			else:
+				# built by gettarinfo like every other member, so that they all carry the same fields,
+				# but always as a regular file, even if this is a symlink or hard link to one
+				tarinfo = tar.gettarinfo(entry.path, os.path.splitext(name)[0] + '.opus')
+				st = entry.stat()
+				tarinfo.type = tarfile_stream.REGTYPE
+				tarinfo.linkname = ''
+				tarinfo.mode = stat.S_IMODE(st.st_mode)
+				tarinfo.mtime = st.st_mtime
+				# don't bother encoding files that would be filtered out anyway
+				if TAR_FILTER is not None and TAR_FILTER(tarinfo) is None:
+					continue
+				pending.append((tarinfo, None, opus_pool.submit(encode_opus, entry.path)))
+				encoding += 1
+
+			while encoding >= opus_lookahead:
+				yield from add_next()
+
+		while pending:
+			yield from add_next()
+	finally:
+		# the client went away before we were done
+		for _, _, job in pending:
+			if job is not None:
+				job.cancel()
+
+def cached_opus(path):
+	"""Encode path into the opus cache unless an encoding of its current version is already there.
+	Return the path of the encoded file relative to the cache.
+	"""
+	digest = hashlib.sha256(os.fsencode(path)).hexdigest()
+	mtime = path.stat().st_mtime_ns
+	name = PurePosixPath(digest[:2], f'{digest}.{mtime}.opus')
+	dest = opus_cache_path / name
+	if dest.exists():
+		return name
+
+	dest.parent.mkdir(parents=True, exist_ok=True)
+	fd, tmp = tempfile.mkstemp(dir=dest.parent, suffix='.tmp')
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			subprocess.run(
+				['opusenc', *OPUSENC_FLAGS, str(path), '-'],
 				stdin=subprocess.DEVNULL,
-				stdout=subprocess.DEVNULL,
+				stdout=f,
 				stderr=subprocess.DEVNULL,
-				bufsize=0,
+				check=True,
 			)
-			proc.wait()
-			yield from tar.add(tmp, (arcname / f.name).with_suffix('.opus'), filter=TAR_FILTER)
+		# mkstemp makes the file private, but the web server has to be able to read it
+		os.chmod(tmp, 0o644)
+		os.replace(tmp, dest)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+
+	# encodings of older versions of this file. newer ones may have been made (and are being served)
+	# by another request while we were encoding, so leave those be.
+	for old in dest.parent.glob(digest + '.*.opus'):
+		if int(old.name.split('.')[1]) < mtime:
+			old.unlink(missing_ok=True)
+
+	return name
 
 @app.route('/._opus/<filename>', defaults={'path': base_path})
 @app.route('/<safe_path:path>/._opus/<filename>')
@@ -256,14 +503,20 @@ def opus(path, filename):
 	if not utils.path_is_opusenc_encodable(path):
 		# just serve it as is
 		return index_dir(path)
-	encoder_proc = subprocess.Popen(
-		['opusenc', *OPUSENC_FLAGS, str(path), '-'],
-		stdin=subprocess.DEVNULL,
-		stdout=subprocess.PIPE,
-		stderr=subprocess.DEVNULL,
-		bufsize=0,
-	)
-	resp = Response(encoder_proc.stdout, mimetype='audio/ogg')
+
+	if opus_cache_path is not None:
+		resp = make_response('')
+		resp.headers['X-Accel-Redirect'] = urllib.parse.urljoin('/._opus_cache/', str(cached_opus(path)))
+		resp.headers['Content-Type'] = 'audio/ogg'
+	else:
+		encoder_proc = subprocess.Popen(
+			['opusenc', *OPUSENC_FLAGS, str(path), '-'],
+			stdin=subprocess.DEVNULL,
+			stdout=subprocess.PIPE,
+			stderr=subprocess.DEVNULL,
+			bufsize=0,
+		)
+		resp = Response(encoder_proc.stdout, mimetype='audio/ogg')
 	resp.headers['Content-Disposition'] = utils.content_disposition('inline', path.with_suffix('.opus').name)
 	return resp
 
@@ -277,36 +530,76 @@ class PygmentsStyle(DefaultStyle):
 	}
 	del styles[pygments.token.Operator.Word]
 
+html_formatter = pygments.formatters.HtmlFormatter(linenos=True, style=PygmentsStyle)
+
+# lexers are looked up once and then shared between requests, so they're never modified after this
+def with_filters(lexer):
+	# highlight "TODO" "XXX" etc
+	lexer.add_filter('codetagify')
+	return lexer
+
+# one lexer per class, however it was asked for (e.g. "py", "python" and "Python" are all the same)
+@lru_cache(maxsize=None)
+def lexer_for_class(cls):
+	return with_filters(cls())
+
+@lru_cache(maxsize=256)
+def lexer_by_name(name):
+	return lexer_for_class(pygments.lexers.find_lexer_class_by_name(name))
+
+@lru_cache(maxsize=256)
+def lexer_for_filename(filename):
+	cls = pygments.lexers.find_lexer_class_for_filename(filename)
+	if cls is None:
+		return lexer_by_name('text')
+	return lexer_for_class(cls)
+
+highlight_cache_size = int(os.environ.get('DIRSERVER_HIGHLIGHT_CACHE_SIZE', '32'))
+# highlighted HTML is several times the size of the source, so only small files are cached
+# in order to keep the cache to tens of megabytes
+HIGHLIGHT_CACHE_MAX_FILE_SIZE = 256 * 1000
+
+def highlighted(path, lexer):
+	# raises ValueError if the file isn't text
+	return pygments.highlight(Path(path).read_text(), lexer, html_formatter)
+
+# keyed on the modification time and size as well, so that a changed file is highlighted afresh.
+# lexer_for_class makes sure there's only one lexer per language, so each file and language has a single entry.
+@lru_cache(maxsize=highlight_cache_size)
+def cached_highlighted(path, mtime_ns, size, lexer):
+	return highlighted(path, lexer)
+
 @app.route('/._hl/<filename>', defaults={'path': base_path})
 @app.route('/<safe_path:path>/._hl/<filename>')
 def highlight(path, filename):
 	path /= filename
-	if not path.is_file():
+	try:
+		st = path.stat()
+	except OSError as exc:
+		if exc.errno in NOT_FOUND_ERRNOS:
+			abort(HTTPStatus.NOT_FOUND)
+		raise
+	if not stat.S_ISREG(st.st_mode):
 		abort(HTTPStatus.NOT_FOUND)
 
-	size = path.stat().st_size
-	if size > 10 * 1000 ** 2:
+	if st.st_size > 10 * 1000 ** 2:
 		return redirect(url_for('.index_dir', path=path))
 
 	try:
-		code = path.read_text()
-	except ValueError:
-		return redirect(url_for('.index_dir', path=path))
-
-	try:
-		lexer = pygments.lexers.get_lexer_by_name(request.args['lang'])
+		lexer = lexer_by_name(request.args['lang'])
 	except (KeyError, ValueError):
-		try:
-			lexer = pygments.lexers.get_lexer_for_filename(filename)
-		except pygments.util.ClassNotFound:
-			lexer = pygments.lexers.get_lexer_by_name('text')
+		lexer = lexer_for_filename(filename)
 
-	# highlight "TODO" "XXX" etc
-	lexer.add_filter('codetagify')
+	try:
+		if st.st_size <= HIGHLIGHT_CACHE_MAX_FILE_SIZE:
+			formatted = cached_highlighted(str(path), st.st_mtime_ns, st.st_size, lexer)
+		else:
+			formatted = highlighted(path, lexer)
+	except ValueError:
+		return redirect(url_for('.index_dir', path=path))
 
-	formatted = pygments.highlight(code, lexer, pygments.formatters.HtmlFormatter(linenos=True, style=PygmentsStyle))
 	relpath = PurePosixPath('/') / path.relative_to(base_path)
-	breadcrumbs_ = list(breadcrumbs(relpath))
+	breadcrumbs_ = breadcrumbs(relpath)
 	breadcrumbs_[-1].link = ''  # current page, as opposed to "raw" link
 
 	return render_template(
@@ -1935,6 +1935,11 @@ class TarFile(object):
         if tarinfo.isreg():
             try:
                 with bltn_open(name, "rb") as f:
+                    if hasattr(os, "posix_fadvise"):
+                        # The whole file is read front to back, so let the
+                        # kernel read ahead as far as it likes.
+                        with contextlib.suppress(OSError):
+                            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
                     yield from self.addfile(tarinfo, f)
             except OSError:
                 return
@@ -1976,6 +1981,31 @@ class TarFile(object):
 
         self.members.append(tarinfo)
 
+    def addbytes(self, tarinfo, data):
+        """Add the TarInfo object `tarinfo' to the archive with the bytes
+           object `data' as its contents. tarinfo.size is set from data.
+           data is yielded in slices of copybufsize, like addfile()'s chunks.
+        """
+        self._check("awx")
+
+        tarinfo = copy.copy(tarinfo)
+        tarinfo.size = len(data)
+
+        buf = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        yield buf
+        self.offset += len(buf)
+        if data:
+            bufsize = self.copybufsize or 16 * 1024
+            for i in range(0, len(data), bufsize):
+                yield data[i:i + bufsize]
+            blocks, remainder = divmod(tarinfo.size, BLOCKSIZE)
+            if remainder > 0:
+                yield NUL * (BLOCKSIZE - remainder)
+                blocks += 1
+            self.offset += blocks * BLOCKSIZE
+
+        self.members.append(tarinfo)
+
     def extractall(self, path=".", members=None, *, numeric_owner=False):
         """Extract all members from the archive to the current working
            directory and set owner, modification time and permissions on
@@ -1,31 +1,48 @@
 # SPDX-License-Identifier: BlueOak-1.0.0
 
 import mimetypes
+import os.path
+import queue
+import threading
 import urllib.parse
+from functools import lru_cache
 
 suffixes = ('KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')
+base = 1000
+default_size_format = '%.1f'
+# (upper bound, suffix, format string for the default format) for each suffix
+units = tuple((base ** i, s, f'{default_size_format} {s}') for i, s in enumerate(suffixes, 2))
 
-def natural_size(value, format='%.1f'):
-	base = 1000
+def natural_size(value, format=default_size_format):
 	bytes = float(value)
 
 	if bytes < base: return '%d B' % bytes
 
-	for i, s in enumerate(suffixes, 2):
-		unit = base ** i
+	for unit, s, unit_format in units:
 		if bytes < unit:
-			return (format + ' %s') % ((base * bytes / unit), s)
-	return (format + ' %s') % ((base * bytes / unit), s)
+			break
+	if format != default_size_format:
+		unit_format = f'{format} {s}'
+	return unit_format % (base * bytes / unit)
 
 AUDIO_BYTES_NEEDED = 12
+# extensions of the formats recognized by mime_type_for_audio_data
+AUDIO_EXTENSIONS = frozenset({'.flac', '.wav', '.aif', '.aiff'})
+
+# first four bytes -> (bytes 8 through 11, if they must match too; mime type)
+AUDIO_MAGIC = {
+	b'fLaC': (None, 'audio/flac'),
+	b'RIFF': (b'WAVE', 'audio/basic'),
+	b'FORM': (b'AIFF', 'audio/x-aiff'),
+}
 
 def mime_type_for_audio_data(data):
-	if data[:4] == b'fLaC':
-		return 'audio/flac'
-	if data[:4] == b'RIFF' and data[8:12] == b'WAVE':
-		return 'audio/basic'
-	if data[:4] == b'FORM' and data[8:12] == b'AIFF':
-		return 'audio/x-aiff'
+	magic = AUDIO_MAGIC.get(data[:4])
+	if magic is None:
+		return None
+	form, mime_type = magic
+	if form is None or data[8:12] == form:
+		return mime_type
 
 data_is_opusenc_encodable = mime_type_for_audio_data
 
@@ -35,6 +52,11 @@ def mime_type_for_audio_path(f):
 
 path_is_opusenc_encodable = mime_type_for_audio_path
 
+def has_hidden_component(path):
+	"""Return whether any component of the /-separated path string starts with a dot."""
+	# about ten times faster than re.search(r'(^|/)\.', path)
+	return path.startswith('.') or '/.' in path
+
 def content_disposition(disposition, filename):
 	filename = urllib.parse.quote(filename).replace('"', r'\"')
 	return f"{disposition}; filename*=utf-8''{filename}"
@@ -44,10 +66,77 @@ mimetypes.add_type('audio/ogg', '.opus')
 for prog_lang_ext in 'txt py c h cpp sh bash zsh fish go rs hh cc awk sql pl pm tcl tk ex exs erl'.split():
 	mimetypes.add_type('text/plain', '.' + prog_lang_ext)
 
+@lru_cache(maxsize=1024)
+def guess_type_for_extensions(extensions):
+	return mimetypes.guess_type('x' + extensions)
+
 def content_type(path):
-	type, charset = mimetypes.guess_type(str(path))
+	# mimetypes only looks at the extensions (e.g. ".tar.gz"), of which there are far fewer than files
+	name = os.path.basename(path).lstrip('.')
+	dot = name.find('.')
+	type, charset = guess_type_for_extensions(name[dot:] if dot != -1 else '')
 	if type is None:
 		return None
 	if charset is None:
 		return type
 	return f'{type}; charset={charset}'
+
+def coalesce(strings, size=64 * 1024):
+	"""Join the strings from an iterable into chunks of at least size characters (except the last),
+	so that each one is worth a write to the client.
+	"""
+	buf = []
+	buffered = 0
+	for s in strings:
+		buf.append(s)
+		buffered += len(s)
+		if buffered >= size:
+			yield ''.join(buf)
+			buf.clear()
+			buffered = 0
+	if buf:
+		yield ''.join(buf)
+
+def pump(chunks, maxsize=64):
+	"""Iterate over chunks in a background thread, so that producing the next chunks overlaps with
+	sending the current one. At most maxsize chunks are buffered.
+	"""
+	q = queue.Queue(maxsize)
+	stop = threading.Event()
+	done = object()
+
+	def put(item):
+		while not stop.is_set():
+			try:
+				q.put(item, timeout=1)
+			except queue.Full:
+				continue
+			return True
+		return False
+
+	def produce():
+		try:
+			for chunk in chunks:
+				if not put(chunk):
+					break
+		# BaseException too (e.g. SystemExit, or GreenletExit under gevent), so that the consumer always wakes up
+		except BaseException as exc:
+			put(exc)
+		else:
+			put(done)
+		finally:
+			if hasattr(chunks, 'close'):
+				chunks.close()
+
+	threading.Thread(target=produce, daemon=True).start()
+	try:
+		while True:
+			item = q.get()
+			if item is done:
+				return
+			if isinstance(item, BaseException):
+				raise item
+			yield item
+	finally:
+		# also tells the producer to stop if the client went away
+		stop.set()